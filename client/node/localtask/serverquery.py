@@ -111,6 +111,8 @@ class ServerQuery(object):
         url = job_web_url if job_web_url else scan_history_url
 
         start_time = time.time()
+        interval = settings.POLLING_INTERVAL_MIN
+        last_result = None
         while True:
             # 判断是否超时
             cur_time = time.time()
@@ -142,7 +144,13 @@ class ServerQuery(object):
 
             # result_code==None,表示还未完成,继续等待和轮询结果(不能直接判非,因为返回0表示扫描成功)
             if result_code is None:
-                time.sleep(settings.POLLING_INTERVAL)
+                # 结果有变化(如进度更新)时重置为最小间隔,否则逐步拉长轮询间隔
+                if result != last_result:
+                    interval = settings.POLLING_INTERVAL_MIN
+                    last_result = result
+                else:
+                    interval = min(interval * settings.POLLING_BACKOFF, settings.POLLING_INTERVAL_MAX)
+                time.sleep(interval)
                 continue
 
             # 返回码是0-99,扫描成功
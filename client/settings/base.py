@@ -5,7 +5,6 @@
 
 import os
 from datetime import timedelta
-from os.path import join
 from settings.edition import *
 
 
@@ -44,31 +43,37 @@ OS_TAG_MAP = {
 #========================
 # puppy根目录
 BASE_DIR = os.path.abspath(os.curdir)
+# 以下路径均基于BASE_DIR,导入时直接拼接常量字符串,无需逐个调用os.path.join
+_SEP = os.sep
+# BASE_DIR为根目录(如/或C:\)时以分隔符结尾,先去掉,与os.path.join的结果保持一致
+_BASE = BASE_DIR.rstrip(_SEP)
 # 数据目录
-DATA_DIR = join(BASE_DIR, "data")
+DATA_DIR = f"{_BASE}{_SEP}data"
 # 源码存放目录
-SOURCE_DIR = join(DATA_DIR, "sourcedirs")
+SOURCE_DIR = f"{DATA_DIR}{_SEP}sourcedirs"
 # 任务工作目录名
 WORK_DIR = "workdir"
 # p2p传输的临时目录
-TEMP_PTP_DIR = join(DATA_DIR, 'temp_ptp')
+TEMP_PTP_DIR = f"{DATA_DIR}{_SEP}temp_ptp"
 # 本地项目资源与工具缓存配置文本
-CACHE_FILE = join(DATA_DIR, "cache.json")
+CACHE_FILE = f"{DATA_DIR}{_SEP}cache.json"
 # PUPPY所需的第三方工具目录
-LIB_BASE_DIR = join(BASE_DIR, 'lib')
+LIB_BASE_DIR = f"{_BASE}{_SEP}lib"
 
 
 #========================
 # 任务执行设置
 #========================
 # 任务目录
-TASK_DIR = join(DATA_DIR, "taskdirs")
+TASK_DIR = f"{DATA_DIR}{_SEP}taskdirs"
 # 任务超时秒数,设置为10天,以最大限度满足所有任务
 TASK_EXPIRED = timedelta(hours=240)
 # 本地私有进程任务执行超时时间（包括远端进程+本地私有进程总和）,设置为10小时,以秒为单位
 LOCAL_TASK_EXPIRED = 10 * 60 * 60
-# 轮询结果的时间间隔,以秒为单位
-POLLING_INTERVAL = 15
+# 轮询结果的时间间隔,以秒为单位: 从最小间隔开始,结果无变化时按退避系数递增,直至最大间隔;结果有变化时重置为最小间隔
+POLLING_INTERVAL_MIN = 2
+POLLING_INTERVAL_MAX = 60
+POLLING_BACKOFF = 1.5
 # 扫描结果轮询的超时时间(5小时)
 POLLING_TMEOUT = 5 * 60 * 60
 # 扫描结束后等待数据入库的时间(20s)
@@ -81,9 +86,9 @@ RESULT_INTO_DB_TIME = 20
 # 默认从Git拉取工具；如果使用本地工具，可以在config.ini中配置该值为True，将不自动拉取内置工具和配置文件
 USE_LOCAL_TOOL = False
 # 默认的工具目录，即puppy根目录下的data/tools目录
-DEFAULT_TOOL_BASE_DIR = join(BASE_DIR, "data/tools")
+DEFAULT_TOOL_BASE_DIR = f"{_BASE}{_SEP}data/tools"
 # 扫描工具目录
-TOOL_BASE_DIR = join(DATA_DIR, "tools")
+TOOL_BASE_DIR = f"{DATA_DIR}{_SEP}tools"
 # 扫描工具配置文件地址，需要在config.ini中配置
 TOOL_CONFIG_URL = ""
 
@@ -5,8 +5,13 @@ cppcheck 扫描任务
 
 import os
 import sys
+import json
+import shutil
 import psutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+from node.app import settings
 from task.scmmgr import SCMMgr
 from util.pathlib import PathMgr
 from task.codelintmodel import CodeLintModel
@@ -17,10 +22,157 @@ from util.exceptions import ConfigError
 from util.pathfilter import FilterPathUtil
 from util.logutil import LogPrinter
 
+# 优先使用lxml(libxml2)解析xml，未安装时回退到标准库
 try:
-    import xml.etree.cElementTree as ET
+    from lxml import etree as ET
+
+    USE_LXML = True
 except ImportError:
-    import xml.etree.ElementTree as ET
+    USE_LXML = False
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+
+# 2019-8-28 偶现系统编码告警(/bin/sh: warning: setlocale: LC_ALL: cannot change locale)被输出到结果文件头部，
+# 解析时从xml声明处开始
+XML_DECLARATION = b"<?xml"
+# 查找xml声明时读取的文件头长度
+XML_HEAD_SIZE = 4096
+
+# 不支持的规则，结果中直接忽略
+UNSUPPORTED_RULES = frozenset(("missingInclude", "MissingIncludeSystem"))
+
+# 规则严重级别映射的本地缓存文件名（位于data目录下），按cppcheck可执行文件的路径、大小和修改时间失效
+ERRORLIST_CACHE_NAME = "cppcheck_errorlist.json"
+
+# 需要扫描的源文件后缀
+CPP_SUFFIXES = (".cpp", ".cxx", ".cc", ".c++", ".c", ".tpp", ".txx")
+
+# 机器cpu核数，用于cppcheck并行参数，只在模块加载时获取一次
+CPU_COUNT = str(psutil.cpu_count() or 1)
+
+# 用于在收集待扫描文件的同时获取cppcheck规则列表
+ERRORLIST_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# 增量解析xml时每次读取的字节数
+XML_CHUNK_SIZE = 1 << 16
+
+
+def _read_chunks(rf):
+    """从文件当前位置开始分块读取到文件末尾"""
+    while True:
+        chunk = rf.read(XML_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _iter_xml_elements(chunks, tag, encoding=None):
+    """将xml内容分块交给XMLPullParser增量解析，逐个返回已解析完成的tag节点
+
+    :param chunks: xml内容块的可迭代对象，如 _read_chunks(rf)
+    :param tag: 需要返回的节点名
+    :param encoding: 覆盖xml声明中的编码，仅lxml解析二进制内容时生效
+    :return: 节点生成器
+    """
+    parser_kwargs = {}
+    if USE_LXML:
+        # lxml支持直接按tag过滤事件
+        parser_kwargs["tag"] = tag
+        if encoding:
+            parser_kwargs["encoding"] = encoding
+    parser = ET.XMLPullParser(events=("end",), **parser_kwargs)
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for _, elem in parser.read_events():
+                if elem.tag == tag:
+                    yield elem
+        parser.close()
+    except ET.ParseError:
+        # lxml在feed出错时直接抛出异常，出错位置之前已解析完成的节点仍需返回
+        for _, elem in parser.read_events():
+            if elem.tag == tag:
+                yield elem
+        raise
+    for _, elem in parser.read_events():
+        if elem.tag == tag:
+            yield elem
+
+
+def _format_error(error, relpos, rules, supported_rules):
+    """将单个<error>节点转换为issue，不符合要求时返回None
+
+    格式为<error id="" severity="" msg=""><location file="" line=""/></error>；
+    属性只取一次attrib后直接下标访问，并先做最廉价的规则过滤，被过滤的节点不再读取location
+    """
+    attrib = error.attrib
+    rule = attrib["id"]
+    # rules已是当前版本cppcheck支持的规则的子集，不在rules中的结果直接过滤
+    if rule not in rules:
+        if rule not in supported_rules:
+            LogPrinter.debug("rule not in supported_rules: %s" % rule)
+        return None
+    if rule in UNSUPPORTED_RULES:
+        LogPrinter.info("unsupported rule:%s" % rule)
+        return None
+    location = error.find("location")
+    if location is None:
+        LogPrinter.info("忽略error: %s" % rule)
+        return None
+    location_attrib = location.attrib
+    return {
+        "path": location_attrib["file"][relpos:],
+        "line": int(location_attrib["line"]),
+        "column": "1",
+        "msg": attrib["msg"],
+        "rule": rule,
+    }
+
+
+def _collect_issues(errors, relpos, rules, supported_rules):
+    """将<error>节点逐个转换为issue，并及时释放已解析的节点，保持内存占用与结果文件大小无关
+
+    结果文件损坏（如cppcheck异常退出导致xml不完整、结果尾部混入其它输出）时，记录日志并返回已解析的结果
+    """
+    issues = []
+    try:
+        for elem in errors:
+            issue = _format_error(elem, relpos, rules, supported_rules)
+            elem.clear()
+            if USE_LXML:
+                # lxml下父节点仍持有已处理的兄弟节点，一并删除
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            if issue:
+                issues.append(issue)
+    except ET.ParseError as err:
+        LogPrinter.warning("结果文件格式有误，忽略剩余内容(已解析%d个问题): %s" % (len(issues), err))
+    return issues
+
+
+def _iter_source_files(root, suffixes):
+    """基于os.scandir遍历root目录，逐个返回后缀匹配的文件路径（统一以/分隔）
+
+    :param root: 遍历的根目录
+    :param suffixes: 小写的文件后缀元组
+    :return: 文件路径生成器
+    """
+    to_posix = os.sep != "/"
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                # 与os.walk默认行为一致：不进入软链接目录，但软链接文件照常扫描
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and entry.name.lower().endswith(suffixes):
+                    yield entry.path.replace(os.sep, "/") if to_posix else entry.path
 
 
 class Cppcheck(CodeLintModel):
@@ -45,32 +197,43 @@ class Cppcheck(CodeLintModel):
         files_path = os.path.join(work_dir, "paths.txt")
         path_mgr = PathMgr()
 
-        toscans = []
-        want_suffix = [".cpp", ".cxx", ".cc", ".c++", ".c", ".tpp", ".txx"]
-        if incr_scan:
-            diffs = SCMMgr(params).get_scm_diff()
-            toscans = [
-                os.path.join(source_dir, diff.path).replace(os.sep, "/")
-                for diff in diffs
-                if diff.path.endswith(tuple(want_suffix)) and diff.state != "del"
-            ]
-        else:
-            toscans = [path.replace(os.sep, "/") for path in PathMgr().get_dir_files(source_dir, tuple(want_suffix))]
-
-        toscans = FilterPathUtil(params).get_include_files(toscans, relpos)
-
-        if not toscans:
-            LogPrinter.debug("To-be-scanned files is empty ")
-            return []
-
-        with open(files_path, "w", encoding="UTF-8") as f:
-            f.write("\n".join(toscans))
-
-        id_severity_map = self._get_id_severity_map()  # 获取当前版本cppcheck的 规则名:严重级别 对应关系
-        supported_rules = id_severity_map.keys()  # 获取当前版本cppcheck支持的所有规则名
+        # 获取当前版本cppcheck的 规则名:严重级别 对应关系，与下面的待扫描文件收集并行执行
+        id_severity_future = ERRORLIST_EXECUTOR.submit(self._get_id_severity_map)
+
+        try:
+            toscans = []
+            if incr_scan:
+                diffs = SCMMgr(params).get_scm_diff()
+                # FilterPathUtil.get_include_files需要对入参取len，这里仍生成list，只保留需要扫描的路径
+                toscans = [
+                    os.path.join(source_dir, diff.path).replace(os.sep, "/")
+                    for diff in diffs
+                    if diff.state != "del" and diff.path.endswith(CPP_SUFFIXES)
+                ]
+            else:
+                toscans = list(_iter_source_files(source_dir, CPP_SUFFIXES))
+
+            toscans = FilterPathUtil(params).get_include_files(toscans, relpos)
+
+            if not toscans:
+                LogPrinter.debug("To-be-scanned files is empty ")
+                self._discard_future(id_severity_future)
+                return []
+
+            # 逐行写入，避免为超长文件列表再拼接一份完整的字符串
+            with open(files_path, "w", encoding="UTF-8", buffering=1 << 20) as f:
+                for path in toscans:
+                    f.write(path)
+                    f.write("\n")
+        except BaseException:
+            self._discard_future(id_severity_future)
+            raise
+
+        id_severity_map = id_severity_future.result()
+        supported_rules = frozenset(id_severity_map)  # 获取当前版本cppcheck支持的所有规则名
         # 过滤掉当前版本cppcheck不支持的规则
-        filtered_rules = [r for r in rules if r not in supported_rules]
-        rules = list(set(rules) - set(filtered_rules))
+        rules = [r for r in rules if r in supported_rules]
+        rules_set = frozenset(rules)
 
         # 执行 cppcheck 工具
         scan_result_path = self._run_cppcheck(files_path, rules, id_severity_map)
@@ -80,29 +243,94 @@ class Cppcheck(CodeLintModel):
             return []
 
         # 格式化结果
-        return self._format_result(source_dir, scan_result_path, rules, supported_rules)
+        return self._format_result(source_dir, scan_result_path, rules_set, supported_rules)
+
+    def _discard_future(self, future):
+        """不再需要规则列表时，取消尚未开始的获取任务；已在执行的等待其结束并记录异常，
+        避免异常被静默丢弃、cppcheck子进程在后台残留到进程退出
+        """
+        if not future.cancel():
+            err = future.exception()
+            if err:
+                LogPrinter.warning("获取cppcheck规则列表失败: %s" % err)
 
     def _get_id_severity_map(self):
         """获取cppcheck所有规则和严重级别的对应关系
 
+        每个任务都在新进程中执行，结果通过data目录下的json文件跨进程复用；
+        缓存以cppcheck可执行文件的stat信息为key，不需要额外启动子进程，cppcheck升级后自动失效
         :return:
         """
+        cppcheck_home = os.environ["CPPCHECK_HOME"]
+        env = EnvSet().get_origin_env()
+        cache_key = self._get_errorlist_cache_key(env)
+        id_severity_map = self._load_errorlist_cache(cache_key)
+        if id_severity_map is None:
+            id_severity_map = self._run_errorlist(cppcheck_home, env)
+            self._dump_errorlist_cache(cache_key, id_severity_map)
+        return id_severity_map
+
+    def _get_errorlist_cache_key(self, env):
+        """根据执行环境PATH找到cppcheck可执行文件，以其路径、大小和修改时间作为缓存key，找不到时返回None"""
+        cppcheck_path = shutil.which("cppcheck", path=env.get("PATH"))
+        if not cppcheck_path:
+            return None
+        try:
+            st = os.stat(cppcheck_path)
+        except OSError:
+            return None
+        return "%s:%d:%d" % (os.path.realpath(cppcheck_path), st.st_size, st.st_mtime_ns)
+
+    def _load_errorlist_cache(self, cache_key):
+        """读取本地缓存的规则列表，key不一致或缓存不可用时返回None"""
+        if cache_key is None:
+            return None
+        try:
+            with open(os.path.join(settings.DATA_DIR, ERRORLIST_CACHE_NAME), "r", encoding="utf-8") as rf:
+                cache = json.load(rf)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cache, dict) or cache.get("key") != cache_key:
+            return None
+        return cache.get("id_severity_map")
+
+    def _dump_errorlist_cache(self, cache_key, id_severity_map):
+        """将规则列表写入本地缓存，写入失败不影响扫描；cache_key为None（找不到cppcheck可执行文件）时不缓存
+
+        缓存文件被并发执行的任务进程共享，先写入同目录下的临时文件再原子替换，避免读到写了一半的文件
+        """
+        if cache_key is None:
+            return
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=ERRORLIST_CACHE_NAME, suffix=".tmp", dir=settings.DATA_DIR)
+            with os.fdopen(fd, "w", encoding="utf-8") as wf:
+                json.dump({"key": cache_key, "id_severity_map": id_severity_map}, wf)
+            os.replace(tmp_path, os.path.join(settings.DATA_DIR, ERRORLIST_CACHE_NAME))
+        except OSError as err:
+            LogPrinter.debug("dump cppcheck errorlist cache failed: %s" % err)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _run_errorlist(self, cppcheck_home, env):
+        """执行cppcheck --errorlist，解析出规则和严重级别的对应关系"""
         cmd_args = ["cppcheck", "--errorlist", "--xml-version=2"]
         errorlist_path = "cppcheck_errorlist.xml"
         return_code = SubProcController(
             cmd_args,
-            cwd=os.environ["CPPCHECK_HOME"],
+            cwd=cppcheck_home,
             stdout_filepath=errorlist_path,
             stderr_line_callback=self.print_log,
-            env=EnvSet().get_origin_env(),
+            env=env,
         ).wait()
         if return_code != 0:
             raise ConfigError("当前机器环境可能不支持cppcheck执行，请查阅任务日志，根据实际情况适配。")
-        with open(errorlist_path, "r") as rf:
-            errorlist = rf.read()
-
-        error_root = ET.fromstring(errorlist).find("errors")
-        id_severity_map = {error.get("id"): error.get("severity") for error in error_root}
+        # 以二进制分块读取并增量解析，由解析器根据xml声明解码
+        id_severity_map = {}
+        with open(errorlist_path, "rb") as rf:
+            for error in _iter_xml_elements(_read_chunks(rf), "error"):
+                id_severity_map[error.get("id")] = error.get("severity")
+                error.clear()
         return id_severity_map
 
     def _get_needed_visitors(self, id_severity_map, rule_list):
@@ -120,34 +348,33 @@ class Cppcheck(CodeLintModel):
         :return:
         """
         CPPCHECK_HOME = os.environ["CPPCHECK_HOME"]
-        path_mgr = PathMgr()
         cmd_args = [
             "cppcheck",
             "--quiet",
-            '--template="{file}[CODEDOG]{line}[CODEDOG]{id}[CODEDOG]{severity}[CODEDOG]{message}"',
+            "--xml",
+            "--xml-version=2",
             "--inconclusive",
         ]
         # LogPrinter.info(f'rules after filtering: {rules}')
         if not rules:
             # cmd_args.append('--enable=all')
             cmd_args.append("--enable=warning,style,information")
-            cmd_args.append("-j %s" % str(psutil.cpu_count()))
+            cmd_args.append("-j %s" % CPU_COUNT)
         else:
+            # visitors是set，排序后保证每次生成的命令行一致
             visitors = self._get_needed_visitors(id_severity_map, rules)
             if visitors:
-                cmd_args.append("--enable=%s" % ",".join(visitors))
+                cmd_args.append("--enable=%s" % ",".join(sorted(visitors)))
             # rules里出现unusedFunction 才不会开启并行检查
             if "unusedFunction" not in rules:
-                cmd_args.append("-j %s" % psutil.cpu_count())
+                cmd_args.append("-j %s" % CPU_COUNT)
 
-        # 添加自定义正则表达式规则--rule-file
-        custom_rules = path_mgr.get_dir_files(os.path.join(CPPCHECK_HOME, "custom_plugins"), ".xml")
-        custom_rules = ["--rule-file=" + rule for rule in custom_rules]
-        cmd_args.extend(custom_rules)
+        # 添加自定义正则表达式规则--rule-file，排序后保证每次生成的命令行一致
+        custom_rules = sorted(PathMgr().get_dir_files(os.path.join(CPPCHECK_HOME, "custom_plugins"), ".xml"))
+        cmd_args.extend("--rule-file=" + rule for rule in custom_rules)
         # 添加代码补丁配置cfg --library
-        custom_cfgs = path_mgr.get_dir_files(os.path.join(CPPCHECK_HOME, "custom_cfg"), ".cfg")
-        custom_cfgs = ["--library=" + cfg for cfg in custom_cfgs]
-        cmd_args.extend(custom_cfgs)
+        custom_cfgs = sorted(PathMgr().get_dir_files(os.path.join(CPPCHECK_HOME, "custom_cfg"), ".cfg"))
+        cmd_args.extend("--library=" + cfg for cfg in custom_cfgs)
 
         # 指定扫描文件
         cmd_args.append("--file-list=%s" % files_path)
@@ -160,24 +387,6 @@ class Cppcheck(CodeLintModel):
             stderr_line_callback=self._error_callback,
             stdout_line_callback=self.print_log,
         ).wait()
-        if not os.path.exists(scan_result_path):
-            return scan_result_path
-        if sys.platform == "win32":
-            result_content = open(scan_result_path, "r", encoding="gbk").read()
-            open(scan_result_path, "w", encoding="utf-8").write(result_content)
-        with open(scan_result_path, "r", encoding="utf-8") as rf:
-            scan_result = rf.read()
-
-        if not scan_result:
-            return scan_result_path
-
-        # 2019-8-28 偶现因为系统编码输出到结果文件，导致解析失败的情况
-        error_msg = "/bin/sh: warning: setlocale: LC_ALL: cannot change locale (en_US.UTF-8)\n"
-        if scan_result.startswith(error_msg):
-            scan_result = scan_result[len(error_msg) :]
-
-        # self.print_log("%s's result: \n%s" % (scan_result_path, scan_result))
-
         return scan_result_path
 
     def _error_callback(self, line):
@@ -192,36 +401,33 @@ class Cppcheck(CodeLintModel):
 
     def _format_result(self, source_dir, scan_result_path, rules, supported_rules):
         """格式化工具执行结果"""
-        issues = []
         relpos = len(source_dir) + 1
-        with open(scan_result_path, "r") as rf:
-            lines = rf.readlines()
-            for line in lines:
-                error = line.split("[CODEDOG]")
-                if len(error) != 5:
-                    LogPrinter.info("该error信息不全或格式有误: %s" % line)
-                    continue
-                if "" in error:
-                    LogPrinter.info("忽略error: %s" % line)
-                    continue
-                rule = error[2]
-                if rule not in supported_rules:  # 没有指定规则时，过滤不在当前版本cppcheck支持的规则中的结果
-                    LogPrinter.debug("rule not in supported_rules: %s" % rule)
-                    continue
-                if rule in ["missingInclude", "MissingIncludeSystem"]:
-                    LogPrinter.info("unsupported rule:%s" % rule)
-                    continue
-                if rule not in rules:
-                    continue
-                # 格式为{file}[CODEDOG]{line}[CODEDOG]{id}[CODEDOG]{severity}[CODEDOG]{message}
-                issue = {}
-                issue["path"] = error[0][relpos:]
-                issue["line"] = int(error[1])
-                issue["column"] = "1"
-                issue["msg"] = error[4]
-                issue["rule"] = rule
-                issues.append(issue)
-        return issues
+        if not os.path.getsize(scan_result_path):
+            return []
+        # windows下cppcheck按系统编码(gbk)输出
+        encoding = "gbk" if sys.platform == "win32" else None
+        with self._open_scan_result(scan_result_path) as rf:
+            errors = _iter_xml_elements(_read_chunks(rf), "error", encoding=encoding)
+            return _collect_issues(errors, relpos, rules, supported_rules)
+
+    def _open_scan_result(self, scan_result_path):
+        """打开结果文件，只读取文件头，从xml声明处开始解析，跳过头部混入的系统编码告警等输出（否则xml解析失败）
+
+        windows下cppcheck按系统编码(gbk)输出：lxml以二进制读取并在解析时指定gbk编码；
+        标准库expat不支持gbk，以gbk解码的文本方式交给解析器。均无需转码重写文件
+        """
+        if sys.platform == "win32" and not USE_LXML:
+            rf = open(scan_result_path, "r", encoding="gbk", errors="replace")
+            xml_decl = XML_DECLARATION.decode()
+        else:
+            rf = open(scan_result_path, "rb")
+            xml_decl = XML_DECLARATION
+        pos = rf.read(XML_HEAD_SIZE).find(xml_decl)
+        rf.seek(0)
+        if pos > 0:
+            # 文本方式打开时不能seek到任意位置，通过读取跳过xml声明之前的内容
+            rf.read(pos)
+        return rf
 
     def check_tool_usable(self, tool_params):
         """